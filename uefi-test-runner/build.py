@@ -3,18 +3,29 @@
 'Script used to build, run, and test the code on all supported platforms.'
 
 import argparse
-import filecmp
+from contextlib import contextmanager
+from functools import lru_cache
+import getpass
+import hashlib
 import json
+import mmap
 import os
 from pathlib import Path
 import re
 import shutil
+import stat
 import subprocess as sp
 import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 ## Configurable settings
 # Path to workspace directory (which contains the top-level `Cargo.toml`)
-WORKSPACE_DIR = Path(__file__).resolve().parents[1]
+WORKSPACE_DIR = Path(os.path.abspath(__file__)).parents[1]
 
 # Try changing these with command line flags, where possible
 SETTINGS = {
@@ -22,12 +33,34 @@ SETTINGS = {
     'arch': 'x86_64',
     # Print commands before running them.
     'verbose': False,
-    # Run QEMU without showing GUI
-    'headless': False,
+    # Run QEMU without showing GUI, unless it is requested with `--gui`
+    'headless': True,
     # Configuration to build.
     'config': 'debug',
     # Disables some tests which don't work in our CI setup
     'ci': False,
+    # Run QEMU with the previously built test runner, without rebuilding it
+    'no_rebuild': False,
+    # Run Cargo before QEMU even if none of the sources changed since the last run
+    'force': False,
+    # Use QEMU's microvm machine on x86_64, which needs the microvm build of OVMF
+    # and disables the graphics tests
+    'microvm': False,
+    # Back the guest's memory with huge pages, if possible
+    'hugepages': False,
+    # Disk controller to which the ESP is attached on x86_64.
+    # Either `virtio`, or `ahci` for the emulated SATA controller.
+    'storage': 'virtio',
+    # Run QEMU without any display device, which disables the graphics tests
+    'no_graphics': False,
+    # Let QEMU write the serial output directly, without analyzing it.
+    # This disables the graphics tests, since screenshots can't be requested.
+    'raw_log': False,
+    # Save the screenshots taken by the tests as the new reference screenshots
+    'update_screenshots': False,
+    # Directory in which Cargo puts the build artifacts, overriding the one
+    # it is configured with. Can be shared with other checkouts, or cached in CI.
+    'target_dir': None,
     # QEMU executable to use
     # Indexed by the `arch` setting
     'qemu_binary': {
@@ -40,57 +73,259 @@ SETTINGS = {
     'ovmf_dir': None,
 }
 
-# Path to target directory. If None, it will be initialized with information
-# from cargo metadata at the first time target_dir function is invoked.
+# This regex can be used to detect and strip ANSI escape codes when
+# analyzing the raw output of the test runner. Sequences start either with
+# `ESC [` or with the CSI character, which can be UTF-8 encoded. Bytes which
+# are part of another UTF-8 encoded character are not mistaken for a CSI.
+ANSI_ESCAPE = re.compile(rb'(?:\x1b\[|\xc2\x9b|(?<![\x80-\xff])\x9b)[0-?]*[ -/]*[@-~]')
+
+# Memory given to the VM on x86_64, in MiB.
+MEMORY_SIZE_MIB = 256
+
+# How long the tests can take to run, in seconds, before QEMU is killed.
+QEMU_TIMEOUT = 10 * 60
+
+# Commands sent to QEMU's monitor. The screenshot's file name still has to be
+# encoded as a JSON string and substituted in.
+QMP_CAPABILITIES_COMMAND = b'{"execute": "qmp_capabilities"}\n'
+SCREENDUMP_COMMAND = '{"execute": "screendump", "arguments": {"filename": %s}}\n'
+
+# Size of the buffer used to read the output of QEMU's serial port. It is large,
+# so that a chatty guest doesn't require one read per line.
+SERIAL_BUFFER_SIZE = 1 << 20
+
+# Linux `ioctl` which makes a file share the data of another one (a reflink).
+FICLONE = 0x40049409
+
+# Memory-backed file system used by the `--ramdisk` option.
+RAMDISK_DIR = Path('/dev/shm')
+
+# Directory in which results are cached between invocations of this script.
+CACHE_DIR = WORKSPACE_DIR / '.build-cache'
+
+# Path to target directory. If None, it will be initialized at the first time
+# target_dir function is invoked.
 TARGET_DIR = None
 
+def cargo_config_files():
+    'Returns the existing Cargo configuration files which apply to the workspace'
+    config_dirs = [path / '.cargo' for path in [WORKSPACE_DIR, *WORKSPACE_DIR.parents]]
+    cargo_home = Path(os.environ.get('CARGO_HOME', Path.home() / '.cargo'))
+    if cargo_home not in config_dirs:
+        config_dirs.append(cargo_home)
+
+    files = []
+    for config_dir in config_dirs:
+        for name in ['config', 'config.toml']:
+            config_file = config_dir / name
+            if config_file.is_file():
+                files.append(config_file)
+    return files
+
+def manifest_fingerprint():
+    'Returns a fingerprint of the files and variables which determine the target directory'
+    manifests = [
+        WORKSPACE_DIR / 'Cargo.toml',
+        # Workspace members are all direct subdirectories of the workspace.
+        *WORKSPACE_DIR.glob('*/Cargo.toml'),
+        # Cargo configuration can override the target directory.
+        *cargo_config_files(),
+    ]
+
+    fingerprint = {}
+    for manifest in manifests:
+        try:
+            st = manifest.stat()
+        except FileNotFoundError:
+            continue
+        fingerprint[str(manifest)] = [st.st_mtime_ns, st.st_size]
+
+    # The environment takes priority over the configuration files.
+    for variable in ['CARGO_TARGET_DIR', 'CARGO_BUILD_TARGET_DIR']:
+        fingerprint[variable] = os.environ.get(variable)
+    return fingerprint
+
+@contextmanager
+def cache_lock(name):
+    'Prevents concurrent runs of this script from updating the same cache entry'
+    CACHE_DIR.mkdir(exist_ok=True)
+    with open(CACHE_DIR / f'{name}.lock', 'w') as lock_file:
+        # File locks are not available on Windows, in which case we just
+        # risk doing the same work twice.
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def write_cache_file(path, text):
+    'Writes a file in the cache, without ever exposing partially written contents'
+    temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    temp_path.write_text(text)
+    os.replace(temp_path, path)
+
+def read_cached_target_dir(cache_file, fingerprint):
+    'Returns the target directory saved in the cache, if it is still valid'
+    try:
+        cached = json.loads(cache_file.read_text())
+        if cached['fingerprint'] == fingerprint:
+            return Path(cached['target_directory'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+@lru_cache(maxsize=None)
+def cargo_binary():
+    'Returns the path to Cargo, which lets `subprocess` start it with `posix_spawn`'
+    return shutil.which('cargo') or 'cargo'
+
+def cargo_metadata_target_dir():
+    'Asks Cargo for the target directory, reusing the answer from previous runs'
+
+    # Running `cargo metadata` is slow, so reuse its result from a previous
+    # invocation as long as none of the manifests have changed.
+    cache_file = CACHE_DIR / 'target_dir.json'
+    fingerprint = manifest_fingerprint()
+    cached = read_cached_target_dir(cache_file, fingerprint)
+    if cached is not None:
+        return cached
+
+    with cache_lock('target_dir'):
+        # Another run might have updated the cache while we were waiting for the lock.
+        cached = read_cached_target_dir(cache_file, fingerprint)
+        if cached is not None:
+            return cached
+
+        # We only need the path of the target directory, so don't resolve
+        # the dependency graph.
+        cmd = [
+            cargo_binary(), 'metadata', '--format-version=1', '--no-deps', '--offline',
+            '--manifest-path', str(WORKSPACE_DIR / 'Cargo.toml'),
+        ]
+        result = sp.run(cmd, stdout=sp.PIPE, check=True, close_fds=False)
+        target_directory = json.loads(result.stdout)['target_directory']
+
+        write_cache_file(cache_file, json.dumps({
+            'fingerprint': fingerprint,
+            'target_directory': target_directory,
+        }))
+    return Path(target_directory)
+
 def target_dir():
     'Returns the target directory'
     global TARGET_DIR
-    if TARGET_DIR is None:
-        cmd = ['cargo', 'metadata', '--format-version=1']
-        result = sp.run(cmd, stdout=sp.PIPE, check=True)
-        TARGET_DIR = Path(json.loads(result.stdout)['target_directory'])
+    if TARGET_DIR is not None:
+        return TARGET_DIR
+
+    # An explicitly requested target directory takes priority over everything.
+    env_target_dir = os.environ.get('CARGO_TARGET_DIR') or os.environ.get('CARGO_BUILD_TARGET_DIR')
+    if SETTINGS['target_dir']:
+        # Don't resolve symbolic links, the directory was either chosen by the user
+        # or checked by `ramdisk_target_dir`.
+        TARGET_DIR = Path(os.path.abspath(SETTINGS['target_dir']))
+    # In case the directory is configured in a way we don't detect,
+    # it's possible to still ask Cargo for it.
+    elif os.environ.get('UEFI_RS_USE_CARGO_METADATA') == '1':
+        TARGET_DIR = cargo_metadata_target_dir()
+    elif env_target_dir:
+        TARGET_DIR = Path(env_target_dir).resolve()
+    # Unless it's been overridden in a config file, Cargo uses the default location.
+    elif not any('target-dir' in config.read_text() for config in cargo_config_files()):
+        TARGET_DIR = WORKSPACE_DIR / 'target'
+    else:
+        TARGET_DIR = cargo_metadata_target_dir()
     return TARGET_DIR
 
+def ramdisk_target_dir():
+    'Returns a private target directory in the ramdisk, creating it if needed'
+
+    # /dev/shm is shared by all users, so give each one their own directory.
+    path = RAMDISK_DIR / f'uefi-rs-target-{getpass.getuser()}'
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    # The name is predictable, so another user could have created it first,
+    # e.g. as a symbolic link, to tamper with the build artifacts.
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise PermissionError(f'`{path}` is not a directory owned by and only writable by the current user')
+    return path
+
+# The following helpers only depend on settings which don't change once the
+# command line has been parsed, so their results are cached.
+
+@lru_cache(maxsize=None)
 def get_target_triple():
     arch = SETTINGS['arch']
     return f'{arch}-unknown-uefi'
 
+@lru_cache(maxsize=None)
+def cargo_target():
+    'Returns the value of the `--target` flag passed to Cargo'
+    target = get_target_triple()
+    # Custom targets need to be given by relative path, instead of only by name
+    # We need to append a `.json` to turn the triple into a path
+    if SETTINGS['arch'] == 'aarch64':
+        target += '.json'
+    return target
+
+@lru_cache(maxsize=None)
 def build_dir():
     'Returns the directory where Cargo places the build artifacts'
     return target_dir() / get_target_triple() / SETTINGS['config']
 
+@lru_cache(maxsize=None)
 def esp_dir():
     'Returns the directory where we will build the emulated UEFI system partition'
     return build_dir() / 'esp'
 
-def run_tool(tool, *flags):
-    'Runs cargo-<tool> with certain arguments.'
+@lru_cache(maxsize=None)
+def boot_file():
+    'Returns the path to the UEFI application started by the firmware'
+    boot_dir = esp_dir() / 'EFI' / 'Boot'
 
-    target = get_target_triple()
-    # Custom targets need to be given by relative path, instead of only by name
-    # We need to append a `.json` to turn the triple into a path
-    if SETTINGS['arch'] == 'aarch64':
-        target += '.json'
+    arch = SETTINGS['arch']
+    if arch == 'x86_64':
+        return boot_dir / 'BootX64.efi'
+    if arch == 'aarch64':
+        return boot_dir / 'BootAA64.efi'
+    raise NotImplementedError('Target arch not supported')
+
+def run_cargo(*args, extra_env=None):
+    'Runs Cargo with certain arguments, and optionally additional environment variables.'
 
-    cmd = ['cargo', tool, '--target', target, *flags]
+    cmd = [cargo_binary(), *args]
 
     if SETTINGS['verbose']:
-        print(' '.join(cmd))
+        # The child process writes to the same output, make sure this comes first.
+        print(' '.join(cmd), flush=True)
 
-    sp.run(cmd, check=True)
+    # Passing the target directory saves Cargo from looking it up again.
+    env = {**os.environ, 'CARGO_TARGET_DIR': str(target_dir()), **(extra_env or {})}
 
-def run_build(*flags):
+    # Cargo writes straight to our output, without going through a pipe. Its
+    # progress bar and colors are left to its own terminal detection: the
+    # commands run one at a time, so the progress bars can't overwrite each other.
+
+    # Python creates file descriptors as non-inheritable,
+    # so spare the child process from closing all of them.
+    sp.run(cmd, check=True, close_fds=False, env=env)
+
+def run_tool(tool, *flags, extra_env=None):
+    'Runs cargo-<tool> with certain arguments.'
+    run_cargo(tool, '--target', cargo_target(), *flags, extra_env=extra_env)
+
+def run_build(*flags, extra_env=None):
     'Runs cargo-build with certain arguments.'
-    run_tool('build', *flags)
+    run_tool('build', *flags, extra_env=extra_env)
 
 def run_clippy(*flags):
     'Runs cargo-clippy with certain arguments.'
     run_tool('clippy', *flags)
 
-def build(*test_flags):
-    'Builds the test crate.'
+def build(*test_flags, clippy=False):
+    'Builds the test crate, optionally compiling it with Clippy\'s driver to lint it too.'
 
     build_args = [
         '--package', 'uefi-test-runner',
@@ -103,38 +338,166 @@ def build(*test_flags):
     if SETTINGS['ci']:
         build_args.extend(['--features', 'ci'])
 
-    run_build(*build_args)
+    extra_env = {}
+    if clippy:
+        clippy_driver = shutil.which('clippy-driver')
+        if clippy_driver is None:
+            raise FileNotFoundError('`clippy-driver` not found, is Clippy installed?')
+        # This is what `cargo clippy` does, except it only checks the code.
+        extra_env['RUSTC_WORKSPACE_WRAPPER'] = clippy_driver
+
+    run_build(*build_args, extra_env=extra_env)
 
     # Copy the built test runner file to the right directory for running tests.
     built_file = build_dir() / 'uefi-test-runner.efi'
 
-    boot_dir = esp_dir() / 'EFI' / 'Boot'
-    boot_dir.mkdir(parents=True, exist_ok=True)
+    output_file = boot_file()
 
-    arch = SETTINGS['arch']
-    if arch == 'x86_64':
-        output_file = boot_dir / 'BootX64.efi'
-    elif arch == 'aarch64':
-        output_file = boot_dir / 'BootAA64.efi'
+    # Skip the copy if the boot file is already the file Cargo produced. Cargo
+    # can go back to an older artifact, so only an exact match is the same file.
+    built_stat = built_file.stat()
+    try:
+        output_stat = output_file.stat()
+        if os.path.samestat(built_stat, output_stat):
+            return
+        if (output_stat.st_size, output_stat.st_mtime_ns) == (built_stat.st_size, built_stat.st_mtime_ns):
+            return
+        output_file.unlink()
+    except FileNotFoundError:
+        # The directory is only missing before the first build.
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+
+    # QEMU only reads the file, so try to avoid copying the data at all.
+    # The file's metadata is not relevant either.
+    try:
+        os.link(built_file, output_file)
+    except OSError:
+        copy_file(built_file, output_file)
+        # Let the next build recognize the copy.
+        os.utime(output_file, ns=(built_stat.st_atime_ns, built_stat.st_mtime_ns))
+
+def copy_file(source, destination):
+    'Copies the contents of a file, letting the kernel do it if possible'
+
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        # On Linux, file systems supporting reflinks (like Btrfs and XFS)
+        # can share the data between the files instead of copying it.
+        if fcntl is not None and sys.platform.startswith('linux'):
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                return
+            except OSError:
+                pass
+
+        # Otherwise, at least avoid copying the data through user space.
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(source_file.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+
+    shutil.copyfile(source, destination)
+
+def source_files(directory):
+    'Yields the files in the given directory tree, except for build outputs and hidden files'
+    with os.scandir(directory) as entries:
+        # Always hash the files in the same order.
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != 'target' and Path(entry.path) != target_dir():
+                    yield from source_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
+def rustc_version():
+    'Returns the verbose version of the compiler Cargo uses for the workspace'
+    rustc = os.environ.get('RUSTC', 'rustc')
+    # Run it from the workspace, so that rustup picks up any toolchain override.
+    result = sp.run([rustc, '-vV'], stdout=sp.PIPE, check=True, close_fds=False, cwd=WORKSPACE_DIR)
+    return result.stdout.decode()
+
+def source_fingerprint(*test_flags):
+    'Returns a digest of everything which the test runner build depends on'
+    digest = hashlib.blake2b()
+    # The compiler's version changes when the toolchain is updated.
+    settings = [test_flags, SETTINGS['config'], SETTINGS['ci'], str(target_dir()), rustc_version()]
+    digest.update(json.dumps(settings).encode())
+
+    # Like Cargo, assume the files didn't change if their metadata didn't.
+    # Cargo's configuration can be outside of the workspace.
+    files = [entry.path for entry in source_files(WORKSPACE_DIR)]
+    files.extend(str(config) for config in cargo_config_files())
+    for path in files:
+        st = os.stat(path)
+        digest.update(f'{path}\0{st.st_mtime_ns}\0{st.st_size}\0'.encode())
+    return digest.hexdigest()
+
+def boot_file_identity():
+    'Returns the metadata which changes whenever the boot file is replaced or rewritten'
+    st = boot_file().stat()
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+def build_if_changed(*test_flags):
+    'Builds the test crate, unless nothing changed since it was last built'
+
+    # Even a build with nothing to do takes Cargo a while, so skip it
+    # entirely if the sources are the same as for the previous build.
+    # Other commands (like `build`) can put a different test runner in the
+    # ESP, so the boot file also has to be the one staged by that build.
+    cache_file = CACHE_DIR / f'build_{get_target_triple()}_{SETTINGS["config"]}.json'
+    fingerprint = source_fingerprint(*test_flags)
+    if not SETTINGS['force']:
+        try:
+            cached = json.loads(cache_file.read_text())
+            if cached['fingerprint'] == fingerprint and cached['boot_file'] == boot_file_identity():
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+
+    build(*test_flags)
 
-    shutil.copy2(built_file, output_file)
+    CACHE_DIR.mkdir(exist_ok=True)
+    write_cache_file(cache_file, json.dumps({
+        'fingerprint': fingerprint,
+        'boot_file': boot_file_identity(),
+    }))
 
 def clippy():
     'Runs Clippy on all projects'
 
     run_clippy('--all')
 
+def check_all():
+    'Builds the test crate and runs Clippy on the workspace with a single Cargo invocation.'
+
+    # The test crate depends on all the other crates of the workspace,
+    # so they all get linted.
+    build(clippy=True)
+
 def doc():
     'Generates documentation for the library crates.'
-    sp.run([
-        'cargo', 'doc', '--no-deps',
+    run_cargo(
+        'doc', '--no-deps',
         '--package', 'uefi',
         '--package', 'uefi-macros',
         '--package', 'uefi-services',
-    ], check=True)
+    )
 
+@lru_cache(maxsize=None)
 def ovmf_files(ovmf_dir):
     'Returns the tuple of paths to the OVMF code and vars firmware files, given the directory'
+    if SETTINGS['microvm']:
+        # The microvm build of OVMF is a single file, without separate vars.
+        return (ovmf_dir / 'MICROVM.fd',)
     if SETTINGS['arch'] == 'x86_64':
         return ovmf_dir / 'OVMF_CODE.fd', ovmf_dir / 'OVMF_VARS.fd'
     if SETTINGS['arch'] == 'aarch64':
@@ -143,8 +506,17 @@ def ovmf_files(ovmf_dir):
 
 def check_ovmf_dir(ovmf_dir):
     'Check whether the given directory contains necessary OVMF files'
-    ovmf_code, ovmf_vars = ovmf_files(ovmf_dir)
-    return ovmf_code.is_file() and ovmf_vars.is_file()
+
+    # Listing the directory once is cheaper than looking up each file,
+    # and tells us right away if the directory doesn't exist.
+    try:
+        with os.scandir(ovmf_dir) as entries:
+            entries = {entry.name: entry for entry in entries}
+    except OSError:
+        return False
+
+    return all(path.name in entries and entries[path.name].is_file()
+               for path in ovmf_files(ovmf_dir))
 
 def find_ovmf():
     'Find path to OVMF files'
@@ -156,33 +528,188 @@ def find_ovmf():
             return ovmf_dir
         raise FileNotFoundError(f'OVMF files not found in `{ovmf_dir}`')
 
-    # Check whether the test runner directory contains the files.
-    ovmf_dir = WORKSPACE_DIR / 'uefi-test-runner'
-    if check_ovmf_dir(ovmf_dir):
-        return ovmf_dir
+    # Reuse the directory found by a previous run. Adding, removing or renaming
+    # files updates a directory's modification time, so as long as neither the
+    # cached directory nor any of the ones searched before it have changed,
+    # the search would give the same result, without having to list them again.
+    firmware = 'microvm' if SETTINGS['microvm'] else SETTINGS['arch']
+    cache_file = CACHE_DIR / f'ovmf_dir_{firmware}.json'
+    try:
+        cached = json.loads(cache_file.read_text())
+        ovmf_dir = Path(cached['ovmf_dir'])
+        if cached['mtimes'] == ovmf_search_mtimes(ovmf_dir):
+            return ovmf_dir
+    except (OSError, ValueError, KeyError):
+        pass
+
+    ovmf_dir = search_ovmf()
+
+    CACHE_DIR.mkdir(exist_ok=True)
+    write_cache_file(cache_file, json.dumps({
+        'ovmf_dir': str(ovmf_dir),
+        'mtimes': ovmf_search_mtimes(ovmf_dir),
+    }))
+    return ovmf_dir
+
+def ovmf_search_paths():
+    'Returns the directories which might contain the OVMF files, by order of priority'
+
+    # The test runner directory comes first.
+    paths = [WORKSPACE_DIR / 'uefi-test-runner']
 
     if sys.platform.startswith('linux'):
-        possible_paths = [
+        paths.extend([
             # Most distros, including CentOS, Fedora, Debian, and Ubuntu.
             Path('/usr/share/OVMF'),
             # Arch Linux
             Path('/usr/share/ovmf/x64'),
-        ]
-        for path in possible_paths:
-            if check_ovmf_dir(path):
-                return path
+        ])
+
+    return paths
+
+def ovmf_search_mtimes(ovmf_dir):
+    'Returns the modification times of the directories searched until the given one'
+
+    mtimes = {}
+    for path in ovmf_search_paths():
+        try:
+            mtimes[str(path)] = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtimes[str(path)] = None
+        if path == ovmf_dir:
+            break
+    return mtimes
+
+def search_ovmf():
+    'Search the usual locations for the OVMF files'
+
+    for path in ovmf_search_paths():
+        if check_ovmf_dir(path):
+            return path
 
     raise FileNotFoundError(f'OVMF files not found anywhere')
 
+def strip_ansi_escapes(line):
+    'Removes the ANSI CSI escape sequences from a line of raw QEMU output'
+
+    # Most lines do not contain any escape codes.
+    if b'\x1b' not in line and b'\x9b' not in line:
+        return line
+
+    return ANSI_ESCAPE.sub(b'', line)
+
+def files_equal(first, second):
+    'Checks whether two files have the same contents'
+
+    size = first.stat().st_size
+    if size != second.stat().st_size:
+        return False
+
+    # Empty files cannot be mapped
+    if size == 0:
+        return True
+
+    with open(first, 'rb') as first_file, open(second, 'rb') as second_file:
+        # Comparing slices of the mapped files is done by `memcmp`, which is
+        # much faster than reading the files. Slices which fit in the CPU's
+        # cache are faster to compare than the whole files at once.
+        with mmap.mmap(first_file.fileno(), 0, access=mmap.ACCESS_READ) as first_map, \
+             mmap.mmap(second_file.fileno(), 0, access=mmap.ACCESS_READ) as second_map:
+            chunk_size = 1 << 20
+            return all(first_map[start:start + chunk_size] == second_map[start:start + chunk_size]
+                       for start in range(0, size, chunk_size))
+
+def read_line_batches(serial_socket):
+    'Yields lists of the lines received from the serial port, one list per read'
+
+    # The same buffer is reused for every read
+    buffer = bytearray(SERIAL_BUFFER_SIZE)
+    view = memoryview(buffer)
+    pending = b''
+    while True:
+        # Get everything that was received so far, in a single call
+        received = serial_socket.recv_into(buffer)
+        if not received:
+            break
+        lines = (pending + view[:received]).split(b'\n')
+        # The last line is not complete yet
+        pending = lines.pop()
+        yield lines
+
+    if pending:
+        yield [pending]
+
+def print_lines(lines):
+    'Prints a batch of lines with a single write'
+    if lines:
+        # Anything printed as text before must come first
+        sys.stdout.flush()
+        sys.stdout.buffer.write(b'\n'.join(lines) + b'\n')
+        sys.stdout.buffer.flush()
+
+def listen_unix_socket(path):
+    'Creates a Unix socket at the given path, waiting for QEMU to connect to it'
+    # Only imported when running QEMU, since it is slow to import
+    import socket
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(path))
+    listener.listen(1)
+    return listener
+
+def accept_qemu_connection(listener, qemu):
+    'Returns the connection QEMU made to the socket, unless QEMU exited before it'
+    import socket
+
+    # Check on QEMU from time to time, in case it failed to start.
+    listener.settimeout(1)
+    while True:
+        try:
+            connection, _ = listener.accept()
+            return connection
+        except socket.timeout:
+            if qemu.poll() is not None:
+                raise RuntimeError('QEMU exited without connecting to its sockets')
+
+def read_monitor_messages(monitor_output):
+    'Yields the JSON messages sent by the QEMU monitor, as soon as they are complete'
+
+    # The replies are parsed with orjson if it's installed, since it's much
+    # faster than the standard library.
+    try:
+        from orjson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
+    buffer = b''
+    while True:
+        chunk = monitor_output.read(4096)
+        if not chunk:
+            return
+        buffer += chunk
+
+        # Every message is terminated by a line break. A single read can
+        # return multiple messages, or only part of one.
+        *messages, buffer = buffer.split(b'\n')
+        for message in messages:
+            if message.strip():
+                yield json_loads(message)
+
 def run_qemu():
     'Runs the code in QEMU.'
 
-    # Rebuild all the changes.
-    build('--features', 'qemu')
+    # Look for the firmware while the tests are being built.
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        ovmf_dir = executor.submit(find_ovmf)
 
-    ovmf_code, ovmf_vars = ovmf_files(find_ovmf())
+        if not SETTINGS['no_rebuild']:
+            # Rebuild all the changes, if there are any.
+            build_if_changed('--features', 'qemu')
+        elif not boot_file().is_file():
+            raise FileNotFoundError(f'`{boot_file()}` has not been built yet, run without `--no-rebuild`')
 
-    qemu_monitor_pipe = 'qemu-monitor'
+        firmware_files = ovmf_files(ovmf_dir.result())
 
     arch = SETTINGS['arch']
 
@@ -199,19 +726,36 @@ def run_qemu():
         ovmf_vars_readonly = 'off'
 
     if arch == 'x86_64':
+        if SETTINGS['microvm']:
+            # A minimal machine without PCI, which boots much faster.
+            # The legacy devices are not needed by the firmware.
+            machine = 'microvm,x-option-roms=off,pit=off,pic=off'
+        else:
+            # Use a modern machine.
+            machine = 'q35'
+
         qemu_flags.extend([
-            # Use a modern machine,.
-            '-machine', 'q35',
+            '-machine', machine,
 
             # Multi-processor services protocol test needs exactly 4 CPUs.
             '-smp', '4',
 
             # Allocate some memory.
-            '-m', '256M',
+            '-m', f'{MEMORY_SIZE_MIB}M',
         ])
+        if SETTINGS['hugepages']:
+            qemu_flags.extend(hugepages_flags(MEMORY_SIZE_MIB))
         if not SETTINGS['ci']:
-            # Enable acceleration if possible.
-            qemu_flags.append('--enable-kvm')
+            # Enable acceleration if possible. QEMU tries the accelerators
+            # in order, and falls back to emulation if none of them works.
+            accelerators = host_accelerators()
+            for accel in accelerators + ['tcg']:
+                qemu_flags.extend(['-accel', accel])
+            # KVM might be usable, so let the guest use all of the host CPU's
+            # features instead of a generic CPU's. Unlike `host`, `max` still
+            # works if QEMU has to fall back to emulation.
+            if accelerators == ['kvm']:
+                qemu_flags.extend(['-cpu', 'max'])
         else:
             # Exit instead of rebooting
             qemu_flags.append('-no-reboot')
@@ -226,21 +770,38 @@ def run_qemu():
     else:
         raise NotImplementedError('Unknown arch')
 
-    qemu_flags.extend([
-        # Set up OVMF.
-        '-drive', f'if=pflash,format=raw,file={ovmf_code},readonly=on',
-        '-drive', f'if=pflash,format=raw,file={ovmf_vars},readonly={ovmf_vars_readonly}',
+    # Mount a local directory as a FAT partition. The VM is thrown away
+    # after each run, so there is no point in flushing its writes.
+    esp_drive = f'format=raw,file=fat:rw:{esp_dir()},cache=unsafe'
 
-        # Mount a local directory as a FAT partition.
-        '-drive', f'format=raw,file=fat:rw:{esp_dir()}',
+    if SETTINGS['microvm']:
+        microvm_firmware, = firmware_files
+        qemu_flags.extend([
+            # Set up OVMF.
+            '-bios', str(microvm_firmware),
 
-        # Connect the serial port to the host. OVMF is kind enough to connect
-        # the UEFI stdout and stdin to that port too.
-        '-serial', 'stdio',
+            # Devices can only be attached to the virtio-mmio transport.
+            '-drive', f'if=none,id=esp,{esp_drive}',
+            '-device', 'virtio-blk-device,drive=esp',
+        ])
+    else:
+        ovmf_code, ovmf_vars = firmware_files
+        qemu_flags.extend([
+            # Set up OVMF.
+            '-drive', f'if=pflash,format=raw,file={ovmf_code},readonly=on',
+            '-drive', f'if=pflash,format=raw,file={ovmf_vars},readonly={ovmf_vars_readonly}',
+        ])
 
-        # Map the QEMU monitor to a pair of named pipes
-        '-qmp', f'pipe:{qemu_monitor_pipe}',
-    ])
+        if arch == 'x86_64' and SETTINGS['storage'] == 'virtio':
+            # Paravirtualized disks need far fewer emulated I/O operations.
+            qemu_flags.extend([
+                '-drive', f'if=none,id=esp,{esp_drive}',
+                '-device', 'virtio-blk-pci,drive=esp',
+            ])
+        else:
+            # The default interface: an AHCI controller on x86_64,
+            # and already virtio on AArch64.
+            qemu_flags.extend(['-drive', esp_drive])
 
     # For now these only work on x86_64
     if arch == 'x86_64':
@@ -254,93 +815,236 @@ def run_qemu():
             #'-debugcon', 'file:debug.log', '-global', 'isa-debugcon.iobase=0x402',
         ])
 
-    # When running in headless mode we don't have video, but we can still have
-    # QEMU emulate a display and take screenshots from it.
-    qemu_flags.extend(['-vga', 'std'])
-    if SETTINGS['headless']:
-        # Do not attach a window to QEMU's display
+    if SETTINGS['no_graphics']:
+        # Do not emulate any display device at all, which speeds up the boot.
+        # The graphics tests are skipped when no display is found.
         qemu_flags.extend(['-display', 'none'])
-
+    else:
+        # When running in headless mode we don't have video, but we can still have
+        # QEMU emulate a display and take screenshots from it.
+        qemu_flags.extend(['-vga', 'std'])
+        if SETTINGS['headless']:
+            # Do not attach a window to QEMU's display
+            qemu_flags.extend(['-display', 'none'])
+
+    # With the full path of the executable, and since we don't close the file
+    # descriptors, `subprocess` starts QEMU with `posix_spawn` instead of
+    # duplicating this process with `fork`.
     qemu_binary = SETTINGS['qemu_binary'][arch]
-    cmd = [qemu_binary] + qemu_flags
+    qemu_binary = shutil.which(qemu_binary) or qemu_binary
+
+    if SETTINGS['raw_log']:
+        run_qemu_raw(qemu_binary, qemu_flags)
+    else:
+        run_qemu_monitored(qemu_binary, qemu_flags)
+
+def free_hugepages():
+    'Returns the number of free huge pages and their size in KiB, as reported by the kernel'
+    meminfo = {}
+    try:
+        with open('/proc/meminfo') as meminfo_file:
+            for line in meminfo_file:
+                name, _, value = line.partition(':')
+                meminfo[name] = value.split()
+        return int(meminfo['HugePages_Free'][0]), int(meminfo['Hugepagesize'][0])
+    except (OSError, KeyError, IndexError, ValueError):
+        return 0, 0
+
+def hugepages_flags(memory_size_mib):
+    'Returns the flags backing the guest memory with huge pages, if they are available'
+
+    # QEMU already asks for transparent huge pages for its normal memory,
+    # so only explicitly reserved huge pages can make a difference.
+    hugepages_dir = '/dev/hugepages'
+    if not os.access(hugepages_dir, os.W_OK):
+        print(f'`{hugepages_dir}` is not writable, not using huge pages', file=sys.stderr)
+        return []
+
+    # QEMU aborts if it can't preallocate all of the memory, which is the case
+    # by default, since no huge pages are reserved.
+    free_pages, page_size_kib = free_hugepages()
+    if free_pages * page_size_kib < memory_size_mib * 1024:
+        print(f'Not enough free huge pages for {memory_size_mib} MiB, not using huge pages',
+              file=sys.stderr)
+        return []
+
+    return [
+        # Preallocate all of the memory, so the guest doesn't fault on it.
+        '-object', f'memory-backend-file,id=mem,size={memory_size_mib}M,mem-path={hugepages_dir},prealloc=on',
+        '-machine', 'memory-backend=mem',
+    ]
+
+def host_accelerators():
+    'Returns the hardware accelerators QEMU can use on this host\'s OS'
+    if sys.platform.startswith('linux'):
+        # Don't have QEMU probe KVM if we can't use it anyway.
+        return ['kvm'] if os.access('/dev/kvm', os.R_OK | os.W_OK) else []
+    if sys.platform == 'darwin':
+        return ['hvf']
+    if sys.platform == 'win32':
+        return ['whpx']
+    return []
+
+def check_qemu_status(cmd, status):
+    'Throws an exception if QEMU failed'
+    if status != 0 and status != 3:
+        raise sp.CalledProcessError(cmd=cmd, returncode=status)
+
+def run_qemu_raw(qemu_binary, qemu_flags):
+    'Runs QEMU with its serial output going straight to our standard output.'
+
+    cmd = [qemu_binary, *qemu_flags,
+        # Connect the serial port to the host. OVMF is kind enough to connect
+        # the UEFI stdout to that port too.
+        '-serial', 'stdio',
+    ]
 
     if SETTINGS['verbose']:
-        print(' '.join(cmd))
+        print(' '.join(cmd), flush=True)
+
+    # Nothing is sent to the VM, so don't let QEMU take over the terminal's input.
+    qemu = sp.Popen(cmd, stdin=sp.DEVNULL, close_fds=False)
+    try:
+        status = qemu.wait(QEMU_TIMEOUT)
+    except sp.TimeoutExpired:
+        print('Tests are taking too long to run, killing QEMU', file=sys.stderr)
+        qemu.kill()
+        status = qemu.wait()
+    check_qemu_status(cmd, status)
+
+def take_screenshot(reference_name, serial_socket, monitor_socket, replies):
+    'Takes the screenshot requested by the VM, and compares it to the reference'
+
+    reference_file = WORKSPACE_DIR / 'uefi-test-runner' / 'screenshots' / (reference_name + '.ppm')
+
+    if SETTINGS['update_screenshots']:
+        # Have QEMU write the screenshot as the new reference
+        screenshot_file = reference_file
+    elif reference_file.exists():
+        screenshot_file = Path('screenshot.ppm')
+    else:
+        # There is nothing to compare the screenshot to, so don't take it
+        print(f'Reference screenshot `{reference_file}` not found, skipping it',
+              file=sys.stderr)
+        serial_socket.sendall(b'OK\n')
+        return
+
+    # Ask QEMU to take a screenshot
+    monitor_command = SCREENDUMP_COMMAND % json.dumps(str(screenshot_file))
+    monitor_socket.sendall(monitor_command.encode())
+
+    # Wait for QEMU's acknowledgement
+    assert next(replies) == {"return": {}}
 
-    # This regex can be used to detect and strip ANSI escape codes when
-    # analyzing the output of the test runner.
-    ansi_escape = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -/]*[@-~]')
+    # Tell the VM that the screenshot was taken
+    serial_socket.sendall(b'OK\n')
 
-    # Setup named pipes as a communication channel with QEMU's monitor
-    monitor_input_path = f'{qemu_monitor_pipe}.in'
-    os.mkfifo(monitor_input_path)
-    monitor_output_path = f'{qemu_monitor_pipe}.out'
-    os.mkfifo(monitor_output_path)
+    if not SETTINGS['update_screenshots']:
+        # Compare screenshot to the reference file specified by the user
+        assert files_equal(screenshot_file, reference_file)
 
-    # Start QEMU
-    qemu = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, universal_newlines=True)
+        # Delete the screenshot once done
+        os.remove(screenshot_file)
+
+def run_qemu_monitored(qemu_binary, qemu_flags):
+    'Runs QEMU, while analyzing its output and answering the screenshot requests.'
+
+    # Setup Unix sockets as communication channels with the serial port and
+    # QEMU's monitor. We listen on them, and QEMU connects to them on startup.
+    import tempfile
+    socket_dir = Path(tempfile.mkdtemp(prefix='uefi-test-runner-'))
+    serial_path = socket_dir / 'serial'
+    monitor_path = socket_dir / 'monitor'
+
+    cmd = [qemu_binary, *qemu_flags,
+        # Connect the serial port to the host. OVMF is kind enough to connect
+        # the UEFI stdout and stdin to that port too.
+        '-chardev', f'socket,id=serial0,path={serial_path}',
+        '-serial', 'chardev:serial0',
+
+        # Map the QEMU monitor to a socket
+        '-qmp', f'unix:{monitor_path}',
+    ]
+
+    if SETTINGS['verbose']:
+        print(' '.join(cmd), flush=True)
+
+    serial_listener = listen_unix_socket(serial_path)
+    monitor_listener = listen_unix_socket(monitor_path)
+
+    # Start QEMU. The sockets are not inheritable, so there's nothing to close.
+    qemu = sp.Popen(cmd, close_fds=False)
+
+    # If the tests hang, killing QEMU closes its sockets, which ends the loop below.
+    # The timeout is recorded first, so it's known as soon as QEMU exits.
+    timed_out = threading.Event()
+    def kill_qemu():
+        timed_out.set()
+        qemu.kill()
+    watchdog = threading.Timer(QEMU_TIMEOUT, kill_qemu)
+    watchdog.start()
     try:
-        # Connect to the QEMU monitor
-        with open(monitor_input_path, mode='w') as monitor_input,                  \
-             open(monitor_output_path, mode='r') as monitor_output:
+        serial_socket = accept_qemu_connection(serial_listener, qemu)
+        monitor_socket = accept_qemu_connection(monitor_listener, qemu)
+
+        with serial_socket, monitor_socket,                                        \
+             monitor_socket.makefile('rb', buffering=0) as monitor_output:
+            # We are only interested in replies, ignore the asynchronous events
+            replies = (message for message in read_monitor_messages(monitor_output)
+                       if 'event' not in message)
+
             # Execute the QEMU monitor handshake, doing basic sanity checks
-            assert monitor_output.readline().startswith('{"QMP":')
-            print('{"execute": "qmp_capabilities"}', file=monitor_input, flush=True)
-            assert monitor_output.readline() == '{"return": {}}\n'
-
-            # Iterate over stdout...
-            for line in qemu.stdout:
-                # Strip ending and trailing whitespace + ANSI escape codes
-                # (This simplifies log analysis and keeps the terminal clean)
-                stripped = ansi_escape.sub('', line.strip())
-
-                # Skip lines which contain nothing else
-                if not stripped:
-                    continue
-
-                # Print out the processed QEMU output for logging & inspection
-                print(stripped)
-
-                # If the app requests a screenshot, take it
-                if stripped.startswith("SCREENSHOT: "):
-                    reference_name = stripped[12:]
-
-                    # Ask QEMU to take a screenshot
-                    monitor_command = '{"execute": "screendump", "arguments": {"filename": "screenshot.ppm"}}'
-                    print(monitor_command, file=monitor_input, flush=True)
-
-                    # Wait for QEMU's acknowledgement, ignoring events
-                    reply = json.loads(monitor_output.readline())
-                    while "event" in reply:
-                        reply = json.loads(monitor_output.readline())
-                    assert reply == {"return": {}}
-
-                    # Tell the VM that the screenshot was taken
-                    print('OK', file=qemu.stdin, flush=True)
-
-                    # Compare screenshot to the reference file specified by the user
-                    # TODO: Add an operating mode where the reference is created if it doesn't exist
-                    reference_file = WORKSPACE_DIR / 'uefi-test-runner' / 'screenshots' / (reference_name + '.ppm')
-                    assert filecmp.cmp('screenshot.ppm', reference_file)
-
-                    # Delete the screenshot once done
-                    os.remove('screenshot.ppm')
-    finally:
-        try:
-            # Wait for QEMU to finish
-            status = qemu.wait()
-        except sp.TimeoutExpired:
-            print('Tests are taking too long to run, killing QEMU', file=sys.stderr)
-            qemu.kill()
-            status = -1
+            assert 'QMP' in next(replies)
+            monitor_socket.sendall(QMP_CAPABILITIES_COMMAND)
+            assert next(replies) == {"return": {}}
+
+            # Iterate over the serial output...
+            for lines in read_line_batches(serial_socket):
+                # The processed QEMU output, printed for logging & inspection
+                output = []
+
+                for line in lines:
+                    # Strip ending and trailing whitespace + ANSI escape codes
+                    # (This simplifies log analysis and keeps the terminal clean)
+                    stripped = strip_ansi_escapes(line).strip()
+
+                    # Skip lines which contain nothing else
+                    if not stripped:
+                        continue
+
+                    output.append(stripped)
+
+                    # If the app requests a screenshot, take it
+                    if stripped.startswith(b'SCREENSHOT: '):
+                        # Keep the log in order with the screenshot's messages
+                        print_lines(output)
+                        output = []
 
-        # Delete the monitor pipes
-        os.remove(monitor_input_path)
-        os.remove(monitor_output_path)
+                        take_screenshot(stripped[12:].decode(), serial_socket, monitor_socket, replies)
 
-        # Throw an exception if QEMU failed
-        if status != 0 and status != 3:
-            raise sp.CalledProcessError(cmd=cmd, returncode=status)
+                print_lines(output)
+    finally:
+        # Wait for QEMU to finish
+        status = qemu.wait()
+        watchdog.cancel()
+        if timed_out.is_set():
+            print('Tests took too long to run, QEMU was killed', file=sys.stderr)
+
+        # Delete the sockets
+        serial_listener.close()
+        monitor_listener.close()
+        shutil.rmtree(socket_dir)
+
+        check_qemu_status(cmd, status)
+
+# Commands which are plain Cargo invocations. Cargo processes sharing a target
+# directory wait on each other's lock, so these are run one after the other.
+CARGO_VERBS = {
+    'build': build,
+    'check-all': check_all,
+    'clippy': clippy,
+    'doc': doc,
+}
 
 def main():
     'Runs the user-requested actions.'
@@ -352,8 +1056,8 @@ def main():
 
     parser = argparse.ArgumentParser(description=desc)
 
-    parser.add_argument('verb', help='command to run', type=str,
-                        choices=['build', 'run', 'doc', 'clippy'])
+    parser.add_argument('verb', help='commands to run (`check-all` combines `build` and `clippy`)',
+                        type=str, nargs='+', choices=[*CARGO_VERBS, 'run'])
 
     parser.add_argument('--target', help='target to build for (default: %(default)s)', type=str,
                         choices=['x86_64', 'aarch64'], default='x86_64')
@@ -361,37 +1065,105 @@ def main():
     parser.add_argument('--verbose', '-v', help='print commands before executing them',
                         action='store_true')
 
-    parser.add_argument('--headless', help='run QEMU without a GUI',
+    parser.add_argument('--gui', help='show the display of the VM in a window',
+                        action='store_true')
+
+    parser.add_argument('--headless', help='run QEMU without a GUI (the default)',
+                        action='store_true')
+
+    parser.add_argument('--no-graphics', help='run QEMU without a display device, skipping the graphics tests',
+                        action='store_true')
+
+    parser.add_argument('--raw-log', help='print the output of QEMU as-is, implies --no-graphics',
+                        action='store_true')
+
+    parser.add_argument('--microvm', help='run on the faster booting microvm machine (x86_64 only), '
+                        'this requires OVMF\'s `MICROVM.fd` and implies --no-graphics',
                         action='store_true')
 
+    parser.add_argument('--storage', help='disk controller for the ESP on x86_64 (default: %(default)s)',
+                        type=str, choices=['virtio', 'ahci'], default='virtio')
+
+    parser.add_argument('--hugepages', help='back the memory of the VM with huge pages (x86_64 only)',
+                        action='store_true')
+
+    parser.add_argument('--target-dir', help='directory for the build artifacts, instead of Cargo\'s',
+                        type=str)
+
+    parser.add_argument('--ramdisk', help='put the build artifacts in memory, in /dev/shm (Linux only)',
+                        action='store_true')
+
+    parser.add_argument('--jobs', '-j', help='number of parallel jobs for each Cargo command',
+                        type=int)
+
     parser.add_argument('--release', help='build in release mode',
                         action='store_true')
 
     parser.add_argument('--ci', help='disables some tests which currently break CI',
                         action='store_true')
 
+    parser.add_argument('--no-rebuild', help='run the previously built tests without rebuilding them',
+                        action='store_true')
+
+    parser.add_argument('--force', help='rebuild the tests before running them, even if nothing changed',
+                        action='store_true')
+
+    parser.add_argument('--update-screenshots', help='save the screenshots as the new references',
+                        action='store_true')
+
     opts = parser.parse_args()
 
     SETTINGS['arch'] = opts.target
     # Check if we need to enable verbose mode
     SETTINGS['verbose'] = opts.verbose
-    SETTINGS['headless'] = opts.headless
+    if opts.gui and opts.headless:
+        parser.error('--gui can\'t be combined with --headless')
+    # Creating a window slows down QEMU's startup, and isn't needed to run the tests.
+    SETTINGS['headless'] = not opts.gui
+    SETTINGS['hugepages'] = opts.hugepages
+    SETTINGS['storage'] = opts.storage
+    SETTINGS['raw_log'] = opts.raw_log
+    if opts.microvm and opts.target != 'x86_64':
+        parser.error('--microvm is only supported on x86_64')
+    SETTINGS['microvm'] = opts.microvm
+    # The microvm machine doesn't have PCI, so it can't have a display either
+    SETTINGS['no_graphics'] = opts.no_graphics or opts.raw_log or opts.microvm
     SETTINGS['config'] = 'release' if opts.release else 'debug'
+    SETTINGS['target_dir'] = opts.target_dir
+    if opts.ramdisk:
+        if opts.target_dir is not None:
+            parser.error('--ramdisk can\'t be combined with --target-dir')
+        if not os.access(RAMDISK_DIR, os.W_OK):
+            parser.error(f'--ramdisk requires a writable `{RAMDISK_DIR}`')
+        try:
+            SETTINGS['target_dir'] = ramdisk_target_dir()
+        except OSError as error:
+            parser.error(f'--ramdisk failed: {error}')
+    if opts.jobs is not None:
+        if opts.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        # Cargo reads this like its own `--jobs`, for all the commands we run.
+        os.environ['CARGO_BUILD_JOBS'] = str(opts.jobs)
     SETTINGS['ci'] = opts.ci
+    SETTINGS['no_rebuild'] = opts.no_rebuild
+    SETTINGS['force'] = opts.force
+    SETTINGS['update_screenshots'] = opts.update_screenshots
+
+    # Debug builds are already compiled incrementally by Cargo. sccache can't
+    # cache incrementally compiled crates, so only use it for release builds.
+    if SETTINGS['config'] == 'release' and shutil.which('sccache'):
+        os.environ.setdefault('RUSTC_WRAPPER', 'sccache')
 
-    verb = opts.verb
+    verbs = opts.verb
 
-    if verb == 'build':
-        build()
-    elif verb == 'clippy':
-        clippy()
-    elif verb == 'doc':
-        doc()
-    elif verb == 'run' or verb is None or opts.verb == '':
-        # Run the program, by default.
+    # Ignore repeated commands, but keep them in order
+    for verb in dict.fromkeys(verbs):
+        if verb in CARGO_VERBS:
+            CARGO_VERBS[verb]()
+
+    # Running the tests is interactive, so it's always done last.
+    if 'run' in verbs:
         run_qemu()
-    else:
-        raise ValueError(f'Unknown verb {opts.verb}')
 
 if __name__ == '__main__':
     try: